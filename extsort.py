@@ -0,0 +1,124 @@
+import os
+import heapq
+import tempfile
+import itertools
+
+# Rough per-field cost of a str held in a Python list, used to turn the
+# length of a row into an estimate of the memory it takes while buffered
+FIELD_OVERHEAD = 64
+
+# Maximum number of chunk files merged at once, keeps us clear of ulimit -n
+MAX_MERGE_FILES = 256
+
+
+def _write_chunk(rows, tmp_dir):
+    fd, path = tempfile.mkstemp(suffix=".tsv", dir=tmp_dir)
+    with os.fdopen(fd, 'w') as chunk_fh:
+        for row in rows:
+            chunk_fh.write('\t'.join(row) + '\n')
+    return path
+
+
+def _read_chunk(path):
+    with open(path) as chunk_fh:
+        for line in chunk_fh:
+            yield line.rstrip('\n').split('\t')
+
+
+def _merge_chunks(paths, key):
+    return heapq.merge(*[_read_chunk(path) for path in paths], key=key)
+
+
+def external_sort(rows, key, max_bytes, tmp_dir=None):
+    """
+    Sort an iterable of rows (lists of str without tabs or newlines) by key,
+    holding at most roughly max_bytes of rows in memory at once.
+
+    Rows are buffered until the budget is reached, then sorted and spilled to
+    a temporary TSV chunk. The chunks are merged lazily, so rows are yielded
+    one at a time. The sort is stable: rows with equal keys come out in the
+    order they went in.
+    """
+    with tempfile.TemporaryDirectory(prefix="asklepian-sort-", dir=tmp_dir) as sort_dir:
+        chunks = []
+        buf = []
+        buf_bytes = 0
+        for row in rows:
+            buf.append(row)
+            buf_bytes += sum(map(len, row)) + FIELD_OVERHEAD * len(row)
+            if buf_bytes >= max_bytes:
+                buf.sort(key=key)
+                chunks.append(_write_chunk(buf, sort_dir))
+                buf = []
+                buf_bytes = 0
+
+        if not chunks:
+            # Everything fit in the budget, no need to touch the disk
+            buf.sort(key=key)
+            yield from buf
+            return
+        if buf:
+            buf.sort(key=key)
+            chunks.append(_write_chunk(buf, sort_dir))
+            buf = []
+
+        # Merge in passes until few enough chunks remain to open at once,
+        # keeping chunks in input order so the merge stays stable
+        while len(chunks) > MAX_MERGE_FILES:
+            merged = []
+            for i in range(0, len(chunks), MAX_MERGE_FILES):
+                group = chunks[i:i + MAX_MERGE_FILES]
+                merged.append(_write_chunk(_merge_chunks(group, key), sort_dir))
+                for path in group:
+                    os.remove(path)
+            chunks = merged
+
+        yield from _merge_chunks(chunks, key)
+
+
+def merge_groups(left, right, left_key, right_key):
+    """
+    Merge two iterables of rows, each already sorted by its key, yielding
+    (key, left_rows, right_rows) for every key in either input (a full outer
+    join). Only the rows for the current key are held in memory.
+    """
+    left_groups = itertools.groupby(left, key=left_key)
+    right_groups = itertools.groupby(right, key=right_key)
+    l = next(left_groups, None)
+    r = next(right_groups, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l[0], list(l[1]), []
+            l = next(left_groups, None)
+        elif l is None or r[0] < l[0]:
+            yield r[0], [], list(r[1])
+            r = next(right_groups, None)
+        else:
+            yield l[0], list(l[1]), list(r[1])
+            l = next(left_groups, None)
+            r = next(right_groups, None)
+
+
+def index_fasta_records(fasta):
+    """
+    Yield (name, start, end) for each record in a FASTA in file order, where
+    start and end are the byte offsets of its sequence lines.
+    """
+    name = None
+    start = offset = 0
+    with open(fasta, 'rb') as fasta_fh:
+        for line in fasta_fh:
+            if line[:1] == b'>':
+                if name is not None:
+                    yield name, start, offset
+                name = line[1:].decode().rstrip('\r\n').partition(" ")[0]
+                start = offset + len(line)
+            offset += len(line)
+    if name is not None:
+        yield name, start, offset
+
+
+def read_fasta_range(fasta_fh, start, end):
+    # Read a sequence from a FASTA opened in binary mode given its byte range
+    fasta_fh.seek(start)
+    return fasta_fh.read(end - start).decode().replace('\n', '').replace('\r', '')
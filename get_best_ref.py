@@ -2,111 +2,258 @@ import os
 import sys
 import csv
 import argparse
+import tempfile
+from operator import itemgetter
 
 from readfq import readfq # thanks heng
+from extsort import external_sort, merge_groups, index_fasta_records, read_fasta_range
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--fasta", required=True)
-parser.add_argument("--metrics", required=True)
-parser.add_argument("--latest", required=False)
-parser.add_argument("--out-ls", required=True)
-args = parser.parse_args()
-
-# Check paths
-if not os.path.isfile(args.fasta):
-    sys.stderr.write("[FAIL] Could not open FASTA %s.\n" % args.fasta)
-    sys.exit(1)
-
-if not os.path.isfile(args.metrics):
-    sys.stderr.write("[FAIL] Could not open Ocarina metrics output %s.\n" % args.metrics)
-    sys.exit(1)
-
-# Keep track of the last best refs so we can flag if the best ref for a sample
-# has changed today
-previous_best = {}
-if args.latest:
-    if not os.path.isfile(args.latest):
-        sys.stderr.write("[FAIL] Could not previous best ref list %s.\n" % args.latest)
-        sys.exit(1)
+# Columns of the metrics needed to pick the best ref, kept by the external sort
+METRICS_FIELDS = ["central_sample_id", "fasta_path", "num_bases", "pc_acgt", "pc_masked", "published_name", "run_name"]
 
-    with open(args.latest) as latest_fh:
+
+def load_previous_best(latest):
+    # Keep track of the last best refs so we can flag if the best ref for a
+    # sample has changed today
+    previous_best = {}
+    with open(latest) as latest_fh:
         for line in latest_fh:
             if line[0] == '[' or line[0] == '#':
                 continue
             fields = line.strip().split('\t')
             previous_best[ fields[0] ] = fields[1]
+    return previous_best
+
 
-best_qc = {}
-n_len_discarded = 0
-
-# Use the metrics from Majora via Ocarina to determine the best sequence
-# for each central_sample_id by tracking the FASTA with the fewest N sites.
-with open(args.metrics) as ocarina_out_fh:
-    for row in csv.DictReader(ocarina_out_fh, delimiter='\t'):
-        fasta_path = os.path.basename(row["fasta_path"])
-        central_sample_id = row["central_sample_id"]
-        num_bases = int(row["num_bases"])
-        pc_acgt = float(row["pc_acgt"])
-        pc_masked = float(row["pc_masked"])
-
-        # Calculate absolute masked bases
-        num_masked = num_bases * (pc_masked/100.0)
-
-        # Remove genomes shorter than 29 Kbp
-        if num_bases < 29000:
-            n_len_discarded += 1
-            continue
-
-        if central_sample_id not in best_qc:
-            # If this is the first genome, assume it is the best
+def update_best_qc(best_qc, row):
+    """
+    Use a row of metrics from Majora via Ocarina to update the best sequence
+    for its central_sample_id, tracking the FASTA with the fewest N sites.
+    Returns False if the row was discarded for length, True otherwise.
+    """
+    fasta_path = os.path.basename(row["fasta_path"])
+    central_sample_id = row["central_sample_id"]
+    num_bases = int(row["num_bases"])
+    pc_acgt = float(row["pc_acgt"])
+    pc_masked = float(row["pc_masked"])
+
+    # Calculate absolute masked bases
+    num_masked = num_bases * (pc_masked/100.0)
+
+    # Remove genomes shorter than 29 Kbp
+    if num_bases < 29000:
+        return False
+
+    if central_sample_id not in best_qc:
+        # If this is the first genome, assume it is the best
+        best_qc[central_sample_id] = [num_masked, row["published_name"], fasta_path]
+    else:
+        # If the best has more masked sites than the current QC
+        # swap to the better run
+        if best_qc[central_sample_id][0] > num_masked:
             best_qc[central_sample_id] = [num_masked, row["published_name"], fasta_path]
-        else:
-            # If the best has more masked sites than the current QC
-            # swap to the better run
-            if best_qc[central_sample_id][0] > num_masked:
+        elif best_qc[central_sample_id][0] == num_masked:
+            # Use run_name lexo to break tie
+            if row["run_name"] > best_qc[central_sample_id][1].split(':')[1]:
                 best_qc[central_sample_id] = [num_masked, row["published_name"], fasta_path]
-            elif best_qc[central_sample_id][0] == num_masked:
-                # Use run_name lexo to break tie
-                if row["run_name"] > best_qc[central_sample_id][1].split(':')[1]:
-                    best_qc[central_sample_id] = [num_masked, row["published_name"], fasta_path]
-
-sys.stderr.write("[NOTE] %s best sequences found. Non-best sequences discarded (for length: %d). Writing FASTA.\n" % (len(best_qc), n_len_discarded))
-
-# Emit all (central_sample_id, best FASTA filename) pairs to stderr
-best_published_names = set([])
-with open(args.out_ls, 'w') as out_ls_fh:
-    for central_sample_id in best_qc:
-        status = 1 # assume new
-        if best_qc[central_sample_id][2] == previous_best.get(central_sample_id):
-            status = 0 # unless new best ref matches last best ref
-
-        out_ls_fh.write('\t'.join([
-            central_sample_id,
-            best_qc[central_sample_id][2],
-            best_qc[central_sample_id][1],
-            str(status),
-        ]) + '\n')
-
-        # Add this sequence's PAG to the best_published_names set
-        best_published_names.add( best_qc[central_sample_id][1] )
-
-# Iterate the matched FASTA and print out sequences that have a name in the best_published_names set
-seen_best_published_names = set([])
-with open(args.fasta) as latest_fasta_fh:
-    for name, seq, qual in readfq(latest_fasta_fh):
-        # Apparently I write the names out wrong so that's good
-        curr_pag = name.split('|')[0].replace('COGUK', 'COG-UK')
-        central_sample_id = curr_pag.split('/')[1]
-        if curr_pag in best_published_names:
-            # Remove deletion chars (https://github.com/COG-UK/dipi-group/issues/38)
-            seq = seq.replace('-', '')
-
-            sys.stdout.write('>%s\n%s\n' % (central_sample_id, seq))
-            seen_best_published_names.add(curr_pag)
-sys.stderr.write("[NOTE] %s best sequences written.\n" % len(seen_best_published_names))
-sys.stderr.write("[NOTE] %s best sequences missing.\n" % (len(best_published_names) - len(seen_best_published_names)))
-
-if len(seen_best_published_names) != len(best_published_names):
-    missing = best_published_names - seen_best_published_names
-    for pag in missing:
-        sys.stderr.write("[WARN] Best sequence found for %s but not written\n" % pag)
+    return True
+
+
+def write_best_ls(best_qc, previous_best, out_ls):
+    # Emit all (central_sample_id, best FASTA filename) pairs to out_ls and
+    # return the set of best PAG names
+    best_published_names = set([])
+    with open(out_ls, 'w') as out_ls_fh:
+        for central_sample_id in best_qc:
+            status = 1 # assume new
+            if best_qc[central_sample_id][2] == previous_best.get(central_sample_id):
+                status = 0 # unless new best ref matches last best ref
+
+            out_ls_fh.write('\t'.join([
+                central_sample_id,
+                best_qc[central_sample_id][2],
+                best_qc[central_sample_id][1],
+                str(status),
+            ]) + '\n')
+
+            # Add this sequence's PAG to the best_published_names set
+            best_published_names.add( best_qc[central_sample_id][1] )
+    return best_published_names
+
+
+def parse_pag(name):
+    # Apparently I write the names out wrong so that's good
+    curr_pag = name.split('|')[0].replace('COGUK', 'COG-UK')
+    central_sample_id = curr_pag.split('/')[1]
+    return curr_pag, central_sample_id
+
+
+def emit_best_seq(central_sample_id, seq):
+    # Remove deletion chars (https://github.com/COG-UK/dipi-group/issues/38)
+    seq = seq.replace('-', '')
+    sys.stdout.write('>%s\n%s\n' % (central_sample_id, seq))
+
+
+def report_missing(best_published_names, seen_best_published_names):
+    sys.stderr.write("[NOTE] %s best sequences written.\n" % len(seen_best_published_names))
+    sys.stderr.write("[NOTE] %s best sequences missing.\n" % (len(best_published_names) - len(seen_best_published_names)))
+
+    if len(seen_best_published_names) != len(best_published_names):
+        missing = best_published_names - seen_best_published_names
+        for pag in missing:
+            sys.stderr.write("[WARN] Best sequence found for %s but not written\n" % pag)
+
+
+def select_best_refs(metrics, latest, out_ls, fasta):
+    previous_best = {}
+    if latest:
+        previous_best = load_previous_best(latest)
+
+    best_qc = {}
+    n_len_discarded = 0
+
+    with open(metrics) as ocarina_out_fh:
+        for row in csv.DictReader(ocarina_out_fh, delimiter='\t'):
+            if not update_best_qc(best_qc, row):
+                n_len_discarded += 1
+
+    sys.stderr.write("[NOTE] %s best sequences found. Non-best sequences discarded (for length: %d). Writing FASTA.\n" % (len(best_qc), n_len_discarded))
+
+    best_published_names = write_best_ls(best_qc, previous_best, out_ls)
+
+    # Iterate the matched FASTA and print out sequences that have a name in the best_published_names set
+    seen_best_published_names = set([])
+    with open(fasta) as latest_fasta_fh:
+        for name, seq, qual in readfq(latest_fasta_fh):
+            curr_pag, central_sample_id = parse_pag(name)
+            if curr_pag in best_published_names:
+                emit_best_seq(central_sample_id, seq)
+                seen_best_published_names.add(curr_pag)
+
+    report_missing(best_published_names, seen_best_published_names)
+
+
+def iter_metrics_rows(metrics):
+    with open(metrics) as ocarina_out_fh:
+        for row in csv.DictReader(ocarina_out_fh, delimiter='\t'):
+            yield [row[field] for field in METRICS_FIELDS]
+
+
+def iter_previous_rows(latest):
+    with open(latest) as latest_fh:
+        for line in latest_fh:
+            if line[0] == '[' or line[0] == '#':
+                continue
+            fields = line.strip().split('\t')
+            yield [fields[0], fields[1]]
+
+
+def iter_best_pags(out_ls):
+    with open(out_ls) as out_ls_fh:
+        for line in out_ls_fh:
+            yield [line.rstrip('\n').split('\t')[2]]
+
+
+def select_best_refs_external(metrics, latest, out_ls, fasta, max_bytes, tmp_dir=None):
+    """
+    Equivalent of the in-memory best ref selection that keeps peak memory
+    within roughly max_bytes, regardless of the size of the inputs.
+
+    The metrics and previous paired.ls are sorted on disk by central_sample_id
+    and merged to pick the best ref and its changed/unchanged status. The best
+    PAGs and an offset index of the matched FASTA are then sorted by PAG and
+    merged to find the sequences to write, which are emitted in FASTA order.
+    The paired.ls is written in central_sample_id order.
+    """
+    # Up to three sorts are live at once, so they share the budget
+    sort_bytes = max(max_bytes // 3, 1)
+    by_first = itemgetter(0)
+
+    sorted_metrics = external_sort(iter_metrics_rows(metrics), by_first, sort_bytes, tmp_dir)
+    sorted_previous = external_sort(iter_previous_rows(latest), by_first, sort_bytes, tmp_dir) if latest else []
+
+    n_best = 0
+    n_len_discarded = 0
+    with open(out_ls, 'w') as out_ls_fh:
+        for central_sample_id, metrics_rows, previous_rows in merge_groups(sorted_metrics, sorted_previous, by_first, by_first):
+            best_qc = {}
+            for row in metrics_rows:
+                if not update_best_qc(best_qc, dict(zip(METRICS_FIELDS, row))):
+                    n_len_discarded += 1
+            if not best_qc:
+                continue
+
+            status = 1 # assume new
+            if previous_rows and best_qc[central_sample_id][2] == previous_rows[-1][1]:
+                status = 0 # unless new best ref matches last best ref
+
+            out_ls_fh.write('\t'.join([
+                central_sample_id,
+                best_qc[central_sample_id][2],
+                best_qc[central_sample_id][1],
+                str(status),
+            ]) + '\n')
+            n_best += 1
+
+    sys.stderr.write("[NOTE] %s best sequences found. Non-best sequences discarded (for length: %d). Writing FASTA.\n" % (n_best, n_len_discarded))
+
+    # Match the best PAGs to the FASTA index, noting the byte range of each
+    # sequence to write and spooling any missing PAGs to report afterwards
+    sorted_index = external_sort(
+        ([*parse_pag(name), str(start), str(end)] for name, start, end in index_fasta_records(fasta)),
+        by_first, sort_bytes, tmp_dir)
+    sorted_best = external_sort(iter_best_pags(out_ls), by_first, sort_bytes, tmp_dir)
+
+    counts = {"seen": 0, "best": 0}
+    missing_fh = tempfile.TemporaryFile('w+', dir=tmp_dir)
+
+    def iter_selected():
+        for curr_pag, index_rows, best_rows in merge_groups(sorted_index, sorted_best, by_first, by_first):
+            if not best_rows:
+                continue
+            counts["best"] += 1
+            if not index_rows:
+                missing_fh.write(curr_pag + '\n')
+                continue
+            counts["seen"] += 1
+            for _, central_sample_id, start, end in index_rows:
+                yield [start, end, central_sample_id]
+
+    with missing_fh, open(fasta, 'rb') as fasta_fh:
+        for start, end, central_sample_id in external_sort(iter_selected(), lambda row: int(row[0]), sort_bytes, tmp_dir):
+            emit_best_seq(central_sample_id, read_fasta_range(fasta_fh, int(start), int(end)))
+
+        sys.stderr.write("[NOTE] %s best sequences written.\n" % counts["seen"])
+        sys.stderr.write("[NOTE] %s best sequences missing.\n" % (counts["best"] - counts["seen"]))
+        missing_fh.seek(0)
+        for pag in missing_fh:
+            sys.stderr.write("[WARN] Best sequence found for %s but not written\n" % pag.rstrip('\n'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fasta", required=True)
+    parser.add_argument("--metrics", required=True)
+    parser.add_argument("--latest", required=False)
+    parser.add_argument("--out-ls", required=True)
+    parser.add_argument("--max-memory", type=int, required=False, help="Sort inputs on disk to keep memory within roughly this many MB")
+    parser.add_argument("--tmp-dir", required=False, help="Directory for on-disk sort chunks (with --max-memory)")
+    args = parser.parse_args()
+
+    # Check paths
+    if not os.path.isfile(args.fasta):
+        sys.stderr.write("[FAIL] Could not open FASTA %s.\n" % args.fasta)
+        sys.exit(1)
+
+    if not os.path.isfile(args.metrics):
+        sys.stderr.write("[FAIL] Could not open Ocarina metrics output %s.\n" % args.metrics)
+        sys.exit(1)
+
+    if args.latest and not os.path.isfile(args.latest):
+        sys.stderr.write("[FAIL] Could not previous best ref list %s.\n" % args.latest)
+        sys.exit(1)
+
+    if args.max_memory:
+        select_best_refs_external(args.metrics, args.latest, args.out_ls, args.fasta, args.max_memory * 1024 * 1024, args.tmp_dir)
+    else:
+        select_best_refs(args.metrics, args.latest, args.out_ls, args.fasta)
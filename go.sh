@@ -18,6 +18,8 @@ source ~/.ocarina
 # ELAN_DATE="YYYYMMDD" # elan dir date
 # WUHAN_FP= # path to wuhan ref
 # COG_PUBLISHED_DIR= # consortium readable root elan publish dir
+### Optional
+# ASKLEPIAN_MAX_MEMORY= # MB, sort best ref and genome table inputs on disk to stay within this budget
 
 while read var; do
       [ -z "${!var}" ] && { echo 'Global Asklepian variable '$var' is empty or not set. Environment likely uninitialised. Aborting.'; exit 64; }
@@ -40,6 +42,7 @@ export AZURE_SAS=$AZURE_SAS
 export AZURE_END=$AZURE_END
 export ASKLEPIAN_DIR=$ASKLEPIAN_DIR
 export WUHAN_FP=$WUHAN_FP
+export ASKLEPIAN_MAX_MEMORY=${ASKLEPIAN_MAX_MEMORY:-}
 
 # For testing, update OUTDIR, PUBDIR, PUBROOT and ensure to override the TABLE_BASENAMEs
 OUTDIR="$ASKLEPIAN_OUTDIR/$DATESTAMP"
@@ -66,20 +69,34 @@ SECONDS=0
 #      sequence has changed today (1) or not (0). This will allow later functions
 #      to decide whether or not to re-process the artifacts (e.g. for variants).
 
+OCARINA_CMD=(ocarina --oauth --env get pag --test-name 'cog-uk-elan-minimal-qc' --pass --task-wait --task-wait-attempts 60
+    --ofield consensus.pc_masked pc_masked 'XXX'
+    --ofield consensus.pc_acgt pc_acgt 'XXX'
+    --ofield consensus.current_path fasta_path 'XXX'
+    --ofield consensus.num_bases num_bases 0
+    --ofield central_sample_id central_sample_id 'XXX'
+    --ofield run_name run_name 'XXX'
+    --ofield published_name published_name 'XXX'
+    --ofield published_date published_date 'XXX'
+    --ofield adm1 adm1 'XXX'
+    --ofield collection_pillar collection_pillar ''
+    --ofield collection_date collection_date ''
+    --ofield received_date received_date '')
+
+# NOTE
+#      If neither step has run, stage_best_ref.py runs the ocarina export and
+#      streams its TSV into the best ref selection while it indexes the
+#      matched FASTA, instead of waiting for the export before reading the FASTA.
+#      The stager keeps the best ref map in memory, so with ASKLEPIAN_MAX_MEMORY
+#      set the export and get_best_ref.py are run one after the other instead.
+if [ ! -f "$OUTDIR/ocarina.ok" ] && [ ! -f "$OUTDIR/best.ok" ] && [ -z "$ASKLEPIAN_MAX_MEMORY" ]; then
+    python $ASKLEPIAN_DIR/stage_best_ref.py --fasta $COG_PUBLISHED_DIR/latest/elan.consensus.matched.fasta --metrics $OUTDIR/consensus.metrics.tsv --latest $LAST_BEST_REFS --out-ls $OUTDIR/best_refs.paired.ls -- "${OCARINA_CMD[@]}" > $OUTDIR/best_refs.paired.fasta 2> $OUTDIR/best_refs.log
+    touch $OUTDIR/ocarina.ok
+    touch $OUTDIR/best.ok
+fi
+
 if [ ! -f "$OUTDIR/ocarina.ok" ]; then
-    ocarina --oauth --env get pag --test-name 'cog-uk-elan-minimal-qc' --pass --task-wait --task-wait-attempts 60 \
-        --ofield consensus.pc_masked pc_masked 'XXX' \
-        --ofield consensus.pc_acgt pc_acgt 'XXX' \
-        --ofield consensus.current_path fasta_path 'XXX' \
-        --ofield consensus.num_bases num_bases 0 \
-        --ofield central_sample_id central_sample_id 'XXX' \
-        --ofield run_name run_name 'XXX' \
-        --ofield published_name published_name 'XXX' \
-        --ofield published_date published_date 'XXX' \
-        --ofield adm1 adm1 'XXX' \
-        --ofield collection_pillar collection_pillar '' \
-        --ofield collection_date collection_date '' \
-        --ofield received_date received_date '' > $OUTDIR/consensus.metrics.tsv
+    "${OCARINA_CMD[@]}" > $OUTDIR/consensus.metrics.tsv
     touch $OUTDIR/ocarina.ok
 else
     echo "[NOTE] Skipping ocarina"
@@ -88,7 +105,7 @@ python -c "import datetime; print('ocarina', str(datetime.timedelta(seconds=$SEC
 SECONDS=0
 
 if [ ! -f "$OUTDIR/best.ok" ]; then
-    python $ASKLEPIAN_DIR/get_best_ref.py --fasta $COG_PUBLISHED_DIR/latest/elan.consensus.matched.fasta --metrics $OUTDIR/consensus.metrics.tsv --latest $LAST_BEST_REFS --out-ls $OUTDIR/best_refs.paired.ls > $OUTDIR/best_refs.paired.fasta 2> $OUTDIR/best_refs.log
+    python $ASKLEPIAN_DIR/get_best_ref.py --fasta $COG_PUBLISHED_DIR/latest/elan.consensus.matched.fasta --metrics $OUTDIR/consensus.metrics.tsv --latest $LAST_BEST_REFS --out-ls $OUTDIR/best_refs.paired.ls ${ASKLEPIAN_MAX_MEMORY:+--max-memory $ASKLEPIAN_MAX_MEMORY --tmp-dir $OUTDIR} > $OUTDIR/best_refs.paired.fasta 2> $OUTDIR/best_refs.log
     touch $OUTDIR/best.ok
 else
     echo "[NOTE] Skipping get_best_ref.py"
@@ -2,95 +2,208 @@ import os
 import sys
 import csv
 import argparse
+import tempfile
+from operator import itemgetter
 
 from readfq import readfq # cheers heng
+from extsort import external_sort, merge_groups, index_fasta_records, read_fasta_range
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--fasta", required=True)
-parser.add_argument("--meta", required=True)
-parser.add_argument("--best-ls", required=True)
-args = parser.parse_args()
-
-# Check files exist
-for fpt, fp in ("FASTA", args.fasta), ("META", args.meta), ("BEST-LS", args.best_ls):
-    if not os.path.isfile(fp):
-        sys.stderr.write("[FAIL] Could not open %s %s.\n" % (fpt, fp))
-        sys.exit(1)
-    else:
-        sys.stderr.write("[NOTE] %s: %s\n" % (fpt, fp))
-
-
-# Map cog to PAG name
-best_pags = {}
-with open(args.best_ls) as best_fh:
-    for line in best_fh:
-        cogid, climb_fn, pag_name, new = line.strip().split('\t')
-        best_pags[cogid] = pag_name
-sys.stderr.write("[NOTE] %d best PAGs loaded\n" % len(best_pags))
-
-# Grab and load the metadata table and extract the required metadata
-# NOTE sample_date defined as collection_date else received_date
-parsed_metadata = {}
-seen_pags = set([])
-with open(args.meta) as metadata_fh:
-    for row in csv.DictReader(metadata_fh, delimiter='\t'):
-        cogid = row["central_sample_id"]
-        pag_name = row["published_name"]
-
-        if cogid not in best_pags:
-            # Ignore cogs without a best PAG, they will have been omitted
-            # e.g. by get_best_ref for being too short
-            continue
-
-        if best_pags[cogid] == pag_name:
-            seen_pags.add(pag_name)
-        else:
-            continue
-
-        sample_date = row["collection_date"]
-
-        # Try the received date if collection date is invalid
-        if not sample_date or sample_date == "None" or len(sample_date) == 0:
-            sample_date = row["received_date"]
-
-        # Give up with an error if impossibly, the sample_date could not be assigned...
-        if not sample_date or sample_date == "None" or len(sample_date) == 0:
-            sys.stderr.write("[FAIL] No sample date for %s\n" % cogid)
-            sys.exit(2)
-
-        parsed_metadata[cogid] = {
-            "adm1": row["adm1"],
-            "collection_pillar": row["collection_pillar"],
-            "collection_or_received_date": sample_date,
-            "published_date": row["published_date"],
-        }
-
-sys.stderr.write("[NOTE] %d samples with metadata loaded\n" % len(parsed_metadata))
-if len(seen_pags) != len(best_pags):
-    missing = set(best_pags.values()) - seen_pags
-    for pag in missing:
-        sys.stderr.write("[WARN] Best PAG found for %s but not matched to metadata\n" % pag)
-    sys.exit(3)
-
-# Load the FASTA, lookup and emit the sample_date and genome sequence
-print(','.join([
+HEADER = [
     "COG-ID",
     "Sample_date",
     "Adm1",
     "Pillar",
     "Published_date",
     "Sequence",
-]))
-with open(args.fasta) as all_fh:
-    for name, seq, qual in readfq(all_fh):
-        central_sample_id = name
-
-        print(','.join([
-            central_sample_id,
-            parsed_metadata[central_sample_id]["collection_or_received_date"],
-            parsed_metadata[central_sample_id]["adm1"],
-            parsed_metadata[central_sample_id]["collection_pillar"],
-            parsed_metadata[central_sample_id]["published_date"],
-            seq,
-        ]))
+]
+
+
+def get_sample_date(cogid, collection_date, received_date):
+    # NOTE sample_date defined as collection_date else received_date
+    sample_date = collection_date
+
+    # Try the received date if collection date is invalid
+    if not sample_date or sample_date == "None" or len(sample_date) == 0:
+        sample_date = received_date
+
+    # Give up with an error if impossibly, the sample_date could not be assigned...
+    if not sample_date or sample_date == "None" or len(sample_date) == 0:
+        sys.stderr.write("[FAIL] No sample date for %s\n" % cogid)
+        sys.exit(2)
+    return sample_date
+
+
+def make_genomes_table(fasta, meta, best_ls):
+    # Map cog to PAG name
+    best_pags = {}
+    with open(best_ls) as best_fh:
+        for line in best_fh:
+            cogid, climb_fn, pag_name, new = line.strip().split('\t')
+            best_pags[cogid] = pag_name
+    sys.stderr.write("[NOTE] %d best PAGs loaded\n" % len(best_pags))
+
+    # Grab and load the metadata table and extract the required metadata
+    parsed_metadata = {}
+    seen_pags = set([])
+    with open(meta) as metadata_fh:
+        for row in csv.DictReader(metadata_fh, delimiter='\t'):
+            cogid = row["central_sample_id"]
+            pag_name = row["published_name"]
+
+            if cogid not in best_pags:
+                # Ignore cogs without a best PAG, they will have been omitted
+                # e.g. by get_best_ref for being too short
+                continue
+
+            if best_pags[cogid] == pag_name:
+                seen_pags.add(pag_name)
+            else:
+                continue
+
+            sample_date = get_sample_date(cogid, row["collection_date"], row["received_date"])
+
+            parsed_metadata[cogid] = {
+                "adm1": row["adm1"],
+                "collection_pillar": row["collection_pillar"],
+                "collection_or_received_date": sample_date,
+                "published_date": row["published_date"],
+            }
+
+    sys.stderr.write("[NOTE] %d samples with metadata loaded\n" % len(parsed_metadata))
+    if len(seen_pags) != len(best_pags):
+        missing = set(best_pags.values()) - seen_pags
+        for pag in missing:
+            sys.stderr.write("[WARN] Best PAG found for %s but not matched to metadata\n" % pag)
+        sys.exit(3)
+
+    # Load the FASTA, lookup and emit the sample_date and genome sequence
+    print(','.join(HEADER))
+    with open(fasta) as all_fh:
+        for name, seq, qual in readfq(all_fh):
+            central_sample_id = name
+
+            print(','.join([
+                central_sample_id,
+                parsed_metadata[central_sample_id]["collection_or_received_date"],
+                parsed_metadata[central_sample_id]["adm1"],
+                parsed_metadata[central_sample_id]["collection_pillar"],
+                parsed_metadata[central_sample_id]["published_date"],
+                seq,
+            ]))
+
+
+def iter_best_rows(best_ls):
+    with open(best_ls) as best_fh:
+        for line in best_fh:
+            cogid, climb_fn, pag_name, new = line.strip().split('\t')
+            yield [cogid, pag_name]
+
+
+def iter_meta_rows(meta):
+    with open(meta) as metadata_fh:
+        for row in csv.DictReader(metadata_fh, delimiter='\t'):
+            yield [
+                row["central_sample_id"],
+                row["published_name"],
+                row["collection_date"],
+                row["received_date"],
+                row["adm1"],
+                row["collection_pillar"],
+                row["published_date"],
+            ]
+
+
+def iter_tsv(fh):
+    for line in fh:
+        yield line.rstrip('\n').split('\t')
+
+
+def make_genomes_table_external(fasta, meta, best_ls, max_bytes, tmp_dir=None):
+    """
+    Equivalent of make_genomes_table that keeps peak memory within roughly
+    max_bytes, regardless of the size of the inputs.
+
+    The best refs and metadata are sorted on disk by central_sample_id and
+    merged to a temporary table of parsed metadata. An offset index of the
+    FASTA is then sorted and merged against that table, and the rows are
+    emitted in FASTA order.
+    """
+    # Up to two sorts are live at once, so they share the budget
+    sort_bytes = max(max_bytes // 2, 1)
+    by_first = itemgetter(0)
+
+    sorted_best = external_sort(iter_best_rows(best_ls), by_first, sort_bytes, tmp_dir)
+    sorted_meta = external_sort(iter_meta_rows(meta), by_first, sort_bytes, tmp_dir)
+
+    n_best = 0
+    n_parsed = 0
+    with tempfile.TemporaryFile('w+', dir=tmp_dir) as parsed_fh, tempfile.TemporaryFile('w+', dir=tmp_dir) as missing_fh:
+        # Ignore cogs without a best PAG, they will have been omitted
+        # e.g. by get_best_ref for being too short
+        for cogid, best_rows, meta_rows in merge_groups(sorted_best, sorted_meta, by_first, by_first):
+            if not best_rows:
+                continue
+            n_best += 1
+            pag_name = best_rows[-1][1]
+            matched_rows = [row for row in meta_rows if row[1] == pag_name]
+            if not matched_rows:
+                missing_fh.write(pag_name + '\n')
+                continue
+
+            for _, _, collection_date, received_date, adm1, collection_pillar, published_date in matched_rows:
+                sample_date = get_sample_date(cogid, collection_date, received_date)
+            parsed_fh.write('\t'.join([cogid, sample_date, adm1, collection_pillar, published_date]) + '\n')
+            n_parsed += 1
+
+        sys.stderr.write("[NOTE] %d best PAGs loaded\n" % n_best)
+        sys.stderr.write("[NOTE] %d samples with metadata loaded\n" % n_parsed)
+        if n_parsed != n_best:
+            missing_fh.seek(0)
+            for pag in missing_fh:
+                sys.stderr.write("[WARN] Best PAG found for %s but not matched to metadata\n" % pag.rstrip('\n'))
+            sys.exit(3)
+
+        # Parsed metadata was written in central_sample_id order, so it can
+        # be merged straight against the sorted FASTA index
+        parsed_fh.seek(0)
+        sorted_index = external_sort(
+            ([name, str(start), str(end)] for name, start, end in index_fasta_records(fasta)),
+            by_first, sort_bytes, tmp_dir)
+
+        def iter_selected():
+            for central_sample_id, index_rows, parsed_rows in merge_groups(sorted_index, iter_tsv(parsed_fh), by_first, by_first):
+                if not index_rows:
+                    continue
+                if not parsed_rows:
+                    sys.stderr.write("[FAIL] No metadata for %s\n" % central_sample_id)
+                    sys.exit(4)
+                for _, start, end in index_rows:
+                    yield [start, end] + parsed_rows[-1]
+
+        print(','.join(HEADER))
+        with open(fasta, 'rb') as fasta_fh:
+            for start, end, *fields in external_sort(iter_selected(), lambda row: int(row[0]), sort_bytes, tmp_dir):
+                print(','.join(fields + [read_fasta_range(fasta_fh, int(start), int(end))]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fasta", required=True)
+    parser.add_argument("--meta", required=True)
+    parser.add_argument("--best-ls", required=True)
+    parser.add_argument("--max-memory", type=int, required=False, help="Sort inputs on disk to keep memory within roughly this many MB")
+    parser.add_argument("--tmp-dir", required=False, help="Directory for on-disk sort chunks (with --max-memory)")
+    args = parser.parse_args()
+
+    # Check files exist
+    for fpt, fp in ("FASTA", args.fasta), ("META", args.meta), ("BEST-LS", args.best_ls):
+        if not os.path.isfile(fp):
+            sys.stderr.write("[FAIL] Could not open %s %s.\n" % (fpt, fp))
+            sys.exit(1)
+        else:
+            sys.stderr.write("[NOTE] %s: %s\n" % (fpt, fp))
 
+    if args.max_memory:
+        make_genomes_table_external(args.fasta, args.meta, args.best_ls, args.max_memory * 1024 * 1024, args.tmp_dir)
+    else:
+        make_genomes_table(args.fasta, args.meta, args.best_ls)
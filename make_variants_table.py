@@ -2,8 +2,8 @@ import os
 import sys
 import argparse
 from readfq import readfq # cheers heng
-from dataclasses import dataclass
-from typing import Union
+from dataclasses import dataclass, field
+from typing import Optional, Union
 import pandas as pd
 
 
@@ -27,6 +27,43 @@ def load_ref_seq(ref):
             return seq
 
 
+def load_ref_seqs(ref):
+    """
+    Load every record in a reference FASTA, keyed (in file order) by name.
+    """
+    ref_seqs = {}
+    with open(ref) as canon_fh:
+        for name, seq, qual in readfq(canon_fh):
+            ref_seqs[name] = seq
+    if not ref_seqs:
+        raise ValueError("[FAIL] Could not read sequence from reference.")
+    return ref_seqs
+
+
+def load_mask(bed_fp):
+    """
+    Load a BED-style region file into a set of 1-based positions to mask.
+
+    Only the first three columns (chrom, start, end) are used. Coordinates are
+    0-based and half-open, as per the BED spec, so the region `MN908947.3 0 3`
+    masks positions 1, 2 and 3. Blank, `#`, `track` and `browser` lines are
+    ignored.
+    """
+    masked_sites = set()
+    with open(bed_fp) as bed_fh:
+        for line_no, line in enumerate(bed_fh, 1):
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            try:
+                start, end = int(fields[1]), int(fields[2])
+            except (IndexError, ValueError):
+                raise ValueError(
+                    f"[FAIL] Malformed BED line {line_no} in {bed_fp}.")
+            masked_sites.update(range(start + 1, end + 1))
+    return frozenset(masked_sites)
+
+
 def get_last_base_call_in_seq(sequence):
     """
     Given a sequence, returns the position of the last base in the sequence
@@ -135,6 +172,44 @@ class SeqComparisonState:
             self._emit(self.curr_pos, ref_base, seq_base, 0)
 
 
+@dataclass
+class VariantProfile:
+    """
+    Class to describe one variant table to be written from a MSA.
+    Several profiles can be evaluated against the same MSA in a single pass
+    by `process_msa_to_profiles`. Each profile has its own analysis window
+    (`analyses_start` and `analyses_end`, as for `SeqComparisonState`), an
+    optional set of masked positions and an optional reference record name
+    (defaults to the first record in the reference FASTA).
+    A call is dropped from a profile if any reference position it covers is
+    masked, i.e. its `Pos` for SNPs and `Pos` to `Pos + len - 1` for
+    deletions.
+    """
+    name: str
+    output: str
+    analyses_start: int = 256
+    analyses_end: int = 29675
+    masked_sites: frozenset = field(default_factory=frozenset)
+    ref_name: Optional[str] = None
+
+    def keep_call(self, pos, seq_base, is_indel, is_padding):
+        """
+        Return whether a call from a wider comparison belongs to this profile.
+        `is_padding` marks the 'N' calls made for unsequenced termini, which
+        are the only calls that depend on the analysis window (see
+        `SeqComparisonState`).
+        """
+        if is_padding and not (
+                self.analyses_start <= pos <= self.analyses_end):
+            return False
+        if self.masked_sites:
+            if is_indel:
+                del_len = int(seq_base[:-1])
+                return self.masked_sites.isdisjoint(range(pos, pos + del_len))
+            return pos not in self.masked_sites
+        return True
+
+
 def process_seq(
         central_sample_id, seq, ref_seq, output='',
         first_analysed_nt=256, last_analysed_nt=29675):
@@ -253,14 +328,146 @@ def process_msa_to_dataframe(
     return pd.DataFrame(columns=column_names, data=data)
 
 
+def process_msa_to_profiles(msa, ref_seq_fp, profiles):
+    """
+    Compare sequences in a MSA to one or more reference sequences and write a
+    csv variants table for each of several profiles, reading the MSA once.
+
+    Each sequence is compared once per distinct reference, across the union
+    of the analysis windows of the profiles using that reference. The calls
+    are then filtered to each profile's window and mask, so each additional
+    profile costs a filter over the calls rather than another pass over the
+    MSA.
+
+    Parameters
+    ----------
+    msa : str or pathlib.Path
+        Path to a multiple sequence alignment file.
+    ref_seq_fp : str or pathlib.Path
+        Path to a FASTA of reference sequences to compare each sequence in
+        the MSA to.
+    profiles : list of VariantProfile
+        Profiles to evaluate. An `output` of '-' writes to stdout.
+    """
+    if len(set(p.name for p in profiles)) != len(profiles):
+        raise ValueError("[FAIL] Profile names must be unique.")
+    ref_seqs = load_ref_seqs(ref_seq_fp)
+    default_ref_name = next(iter(ref_seqs))
+
+    # Group profiles by reference so that each sequence is only compared to
+    # each reference once
+    profiles_by_ref = {}
+    for profile in profiles:
+        ref_name = profile.ref_name or default_ref_name
+        if ref_name not in ref_seqs:
+            raise ValueError(
+                f"[FAIL] Reference {ref_name} for profile {profile.name} not "
+                f"found in {ref_seq_fp}.")
+        profiles_by_ref.setdefault(ref_name, []).append(profile)
+
+    column_names = ['COG-ID', 'Position', 'Reference_Base', 'Alternate_Base',
+                    'Is_Indel']
+    handles = {}
+    try:
+        for profile in profiles:
+            if profile.output == '-':
+                handles[profile.name] = sys.stdout
+            else:
+                handles[profile.name] = open(profile.output, 'w')
+            handles[profile.name].write(','.join(column_names))
+            handles[profile.name].write('\n')
+
+        with open(msa) as all_fh:
+            for central_sample_id, seq, _ in readfq(all_fh):
+                for ref_name, ref_profiles in profiles_by_ref.items():
+                    calls = process_seq(
+                        central_sample_id, seq, ref_seqs[ref_name], output=[],
+                        first_analysed_nt=min(
+                            p.analyses_start for p in ref_profiles),
+                        last_analysed_nt=max(
+                            p.analyses_end for p in ref_profiles))
+                    # 'N' calls where the aligned base is a gap are padding
+                    is_padding = [
+                        seq_base == 'N' and seq[pos - 1] == '-'
+                        for _, pos, _, seq_base, _ in calls]
+                    for profile in ref_profiles:
+                        handles[profile.name].write(''.join(
+                            ','.join([name, str(pos), ref_base, seq_base,
+                                      str(is_indel)]) + '\n'
+                            for (name, pos, ref_base, seq_base, is_indel),
+                            padding in zip(calls, is_padding)
+                            if profile.keep_call(
+                                pos, seq_base, is_indel, padding)))
+    finally:
+        for fh in handles.values():
+            if fh is not sys.stdout:
+                fh.close()
+
+    for profile in profiles:
+        sys.stderr.write("[NOTE] Profile %s written to %s\n" % (
+            profile.name, profile.output))
+
+
+def parse_profile(spec):
+    """
+    Parse a `--profile` argument of the form
+    `name=NAME out=PATH [start=INT] [end=INT] [mask=BED] [ref=RECORD]`
+    into a VariantProfile.
+    """
+    options = {}
+    for item in spec:
+        key, sep, value = item.partition('=')
+        if not sep or key not in (
+                'name', 'out', 'start', 'end', 'mask', 'ref'):
+            raise ValueError(f"[FAIL] Invalid profile option {item}.")
+        options[key] = value
+    if 'name' not in options or 'out' not in options:
+        raise ValueError(
+            f"[FAIL] Profile {' '.join(spec)} requires a name and out.")
+    profile = VariantProfile(options['name'], options['out'])
+    if 'start' in options:
+        profile.analyses_start = int(options['start'])
+    if 'end' in options:
+        profile.analyses_end = int(options['end'])
+    if 'mask' in options:
+        if not os.path.isfile(options['mask']):
+            raise FileNotFoundError(
+                f"[FAIL] Could not open MASK {options['mask']}.")
+        profile.masked_sites = load_mask(options['mask'])
+    if 'ref' in options:
+        profile.ref_name = options['ref']
+    return profile
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--ref", required=True)
     parser.add_argument("--msa", required=True)
+    parser.add_argument(
+        "--profile", nargs='+', action='append', metavar='KEY=VALUE',
+        help="Write a variant table for an extra window, mask or reference: "
+             "name=NAME out=PATH [start=INT] [end=INT] [mask=BED] "
+             "[ref=RECORD]. May be repeated; all profiles are evaluated in "
+             "one pass of the MSA.")
     args = parser.parse_args()
     try:
         check_exist(args.ref, args.msa)
     except FileNotFoundError as e:
         sys.stderr.write(f'{e}\n')
         sys.exit(1)
-    process_msa_to_cmd_line(args.msa, args.ref)
+    if not args.profile:
+        process_msa_to_cmd_line(args.msa, args.ref)
+    else:
+        try:
+            profiles = [parse_profile(spec) for spec in args.profile]
+        except FileNotFoundError as e:
+            sys.stderr.write(f'{e}\n')
+            sys.exit(1)
+        except ValueError as e:
+            sys.stderr.write(f'{e}\n')
+            sys.exit(2)
+        try:
+            process_msa_to_profiles(args.msa, args.ref, profiles)
+        except ValueError as e:
+            sys.stderr.write(f'{e}\n')
+            sys.exit(2)
@@ -0,0 +1,120 @@
+import os
+import sys
+import csv
+import asyncio
+import argparse
+
+from extsort import index_fasta_records, read_fasta_range
+from get_best_ref import (load_previous_best, update_best_qc, write_best_ls,
+                          parse_pag, emit_best_seq, report_missing)
+
+
+async def stream_metrics(metrics_cmd, metrics_out, best_qc):
+    """
+    Run the metrics command (usually `ocarina get pag ...`), writing its TSV
+    stdout to `metrics_out` as it arrives and updating `best_qc` row by row.
+    Returns the number of rows discarded for length.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *metrics_cmd, stdout=asyncio.subprocess.PIPE)
+
+    n_len_discarded = 0
+    header = None
+    with open(metrics_out, 'w') as metrics_fh:
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            line = line.decode()
+            metrics_fh.write(line)
+            if not line.strip():
+                continue
+            fields = next(csv.reader([line], delimiter='\t'))
+            if header is None:
+                header = fields
+                continue
+            if not update_best_qc(best_qc, dict(zip(header, fields))):
+                n_len_discarded += 1
+
+    returncode = await proc.wait()
+    if returncode != 0:
+        raise RuntimeError("[FAIL] Metrics command exited with status %d." % returncode)
+    return n_len_discarded
+
+
+def index_fasta(fasta):
+    """
+    Read the matched FASTA once, recording the byte range of the sequence of
+    each record in file order as (name, start, end). This also warms the page
+    cache for the reads made when the best sequences are emitted.
+    """
+    return list(index_fasta_records(fasta))
+
+
+def emit_indexed_best_seqs(fasta, index, best_published_names):
+    # Seek to and print out sequences that have a name in the
+    # best_published_names set, in the order they appear in the FASTA
+    seen_best_published_names = set([])
+    with open(fasta, 'rb') as fasta_fh:
+        for name, start, end in index:
+            curr_pag, central_sample_id = parse_pag(name)
+            if curr_pag in best_published_names:
+                emit_best_seq(central_sample_id, read_fasta_range(fasta_fh, start, end))
+                seen_best_published_names.add(curr_pag)
+    return seen_best_published_names
+
+
+async def stage_best_refs(metrics_cmd, metrics_out, fasta, out_ls, previous_best):
+    """
+    Stream the metrics and index the matched FASTA concurrently, then write
+    the best ref list and emit the best sequences once both are ready.
+    """
+    loop = asyncio.get_running_loop()
+    best_qc = {}
+    n_len_discarded, index = await asyncio.gather(
+        stream_metrics(metrics_cmd, metrics_out, best_qc),
+        loop.run_in_executor(None, index_fasta, fasta),
+    )
+    sys.stderr.write("[NOTE] %d FASTA records indexed.\n" % len(index))
+    sys.stderr.write("[NOTE] %s best sequences found. Non-best sequences discarded (for length: %d). Writing FASTA.\n" % (len(best_qc), n_len_discarded))
+
+    best_published_names = write_best_ls(best_qc, previous_best, out_ls)
+    seen_best_published_names = emit_indexed_best_seqs(fasta, index, best_published_names)
+    report_missing(best_published_names, seen_best_published_names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Run the Ocarina metrics export and get_best_ref.py concurrently. "
+                    "The metrics command follows a '--', e.g. '-- ocarina --oauth get pag ...'.")
+    parser.add_argument("--fasta", required=True)
+    parser.add_argument("--metrics", required=True, help="Path to write the metrics TSV to")
+    parser.add_argument("--latest", required=False)
+    parser.add_argument("--out-ls", required=True)
+    parser.add_argument("metrics_cmd", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    metrics_cmd = args.metrics_cmd
+    if metrics_cmd and metrics_cmd[0] == '--':
+        metrics_cmd = metrics_cmd[1:]
+    if not metrics_cmd:
+        sys.stderr.write("[FAIL] No metrics command given.\n")
+        sys.exit(1)
+
+    # Check paths
+    if not os.path.isfile(args.fasta):
+        sys.stderr.write("[FAIL] Could not open FASTA %s.\n" % args.fasta)
+        sys.exit(1)
+
+    previous_best = {}
+    if args.latest:
+        if not os.path.isfile(args.latest):
+            sys.stderr.write("[FAIL] Could not previous best ref list %s.\n" % args.latest)
+            sys.exit(1)
+        previous_best = load_previous_best(args.latest)
+
+    try:
+        asyncio.run(stage_best_refs(metrics_cmd, args.metrics, args.fasta, args.out_ls, previous_best))
+    except RuntimeError as e:
+        sys.stderr.write(f'{e}\n')
+        sys.exit(2)